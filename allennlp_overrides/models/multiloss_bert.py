@@ -1,7 +1,9 @@
-from typing import Dict, Union
+from typing import Union
+import math
 
 import torch
 
+from allennlp.common.checks import ConfigurationError
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.models.model import Model
 from allennlp.nn.initializers import InitializerApplicator
@@ -36,6 +38,8 @@ class MultilossBert(Model):
         Indices for layers for which linear layers are learned
     multitask: ``bool``, optional (default: false)
         Do multitask learning (rather than summing all losses)
+    half_precision: ``bool``, optional (default: false)
+        Run the BERT encoder under bfloat16 autocast (requires PyTorch >= 1.10)
     initializer : ``InitializerApplicator``, optional
         If provided, will be used to initialize the final linear layer *only*.
     """
@@ -53,9 +57,13 @@ class MultilossBert(Model):
                  multitask: bool = False,
                  debug: bool = False,
                  add_previous_layer_logits: bool = True,
+                 half_precision: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super().__init__(vocab)
 
+        if half_precision and not hasattr(torch, "autocast"):
+            raise ConfigurationError("half_precision requires PyTorch >= 1.10 (found {})".format(torch.__version__))
+
         if isinstance(bert_model, str):
             self.bert_model = LayeredPretrainedBertModel.load(bert_model)
         else:
@@ -67,6 +75,8 @@ class MultilossBert(Model):
 
         self._add_previous_layer_logits = add_previous_layer_logits
         self._layer_indices = [int(x) for x in layer_indices.split("_")]
+        # The first BERT layer to run for each classifier, when resuming from the previous classifier's layer
+        self._start_indices = [0] + [x+1 for x in self._layer_indices[:-1]]
         self._sum_weights = torch.nn.ParameterList([torch.nn.Parameter(torch.randn(i+1)) for i in self._layer_indices])
         self._multitask = multitask
         self._debug = debug
@@ -85,24 +95,43 @@ class MultilossBert(Model):
 
         self._count_n_layers = CountNLayers(self._layer_indices)
         self._index = index
+        self._type_ids_key = f"{index}-type-ids"
         self._scaling_temperatures = [float(x) for x in scaling_temperature.split("_")]
+        if len(self._scaling_temperatures) != len(self._layer_indices):
+            raise ConfigurationError("Received {} scaling temperatures ({}) for {} layers ({})".format(
+                len(self._scaling_temperatures), scaling_temperature, len(self._layer_indices), layer_indices))
         self._temperature_threshold = temperature_threshold
+        self._half_precision = half_precision
 
     def _normalize_sum_weights(self):
-        for i in range(len(self._sum_weights)):
-            self._sum_weights[i] = torch.nn.Parameter(torch.nn.functional.normalize(self._sum_weights[i], p=2, dim=0)) # unit length
-        #data[i] = vec / torch.norm(vec)
+        # Normalize to unit length in place, so that the registered parameters (and the optimizer's
+        # references to them) are kept, rather than replaced by new tensors on every forward pass
+        with torch.no_grad():
+            for sum_weights in self._sum_weights:
+                sum_weights.div_(sum_weights.norm(p=2).clamp(min=1e-12))
+
+    def _is_confident(self, logits):
+        """Check whether the most confident prediction passes the temperature threshold.
+        Compares log-probabilities against the log threshold, which avoids computing the full softmax"""
+        if self._temperature_threshold <= 0:
+            return True
+
+        max_log_prob = torch.max(logits - torch.logsumexp(logits, dim=-1, keepdim=True)).item()
+
+        return max_log_prob >= math.log(self._temperature_threshold)
 
     def _run_layer(self, input_ids, token_type_ids, input_mask, layer_index, start_index, previous_layer, previous_pooled):
         """Run model on a single layer"""
-        encoded_layer, pooled = self.bert_model(input_ids=input_ids,
-                                                token_type_ids=token_type_ids,
-                                                attention_mask=input_mask,
-                                                output_all_encoded_layers=True,
-                                                layer_index=self._layer_indices[layer_index],
-                                                num_predicted_hidden_layers=self._layer_indices[layer_index],
-                                                start_index=start_index, previous_layer=previous_layer
-                                                )
+        if self._half_precision:
+            with torch.autocast(device_type=input_ids.device.type, dtype=torch.bfloat16):
+                encoded_layer, pooled = self._run_bert(input_ids, token_type_ids, input_mask, layer_index,
+                                                       start_index, previous_layer)
+
+            # Classifiers and losses are computed in full precision
+            pooled = pooled.float()
+        else:
+            encoded_layer, pooled = self._run_bert(input_ids, token_type_ids, input_mask, layer_index,
+                                                   start_index, previous_layer)
 
         # pooled in BERT classification task is the CLS tag (i.e., the first element)
         pooled = self._dropout(pooled)
@@ -112,3 +141,13 @@ class MultilossBert(Model):
 
         return encoded_layer[-1], pooled
 
+    def _run_bert(self, input_ids, token_type_ids, input_mask, layer_index, start_index, previous_layer):
+        """Run the BERT encoder from start_index up to (and including) the given layer"""
+        return self.bert_model(input_ids=input_ids,
+                               token_type_ids=token_type_ids,
+                               attention_mask=input_mask,
+                               output_all_encoded_layers=True,
+                               layer_index=self._layer_indices[layer_index],
+                               num_predicted_hidden_layers=self._layer_indices[layer_index],
+                               start_index=start_index, previous_layer=previous_layer
+                               )
@@ -5,6 +5,7 @@ import torch
 import random
 import copy
 
+from allennlp.common.checks import ConfigurationError
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.models.model import Model
 from allennlp.nn.initializers import InitializerApplicator
@@ -13,6 +14,17 @@ from allennlp_overrides.modules.token_embedders.layered_bert_token_embedder impo
 from .multiloss_bert import MultilossBert
 
 
+def _classifier_logits(pooled, sum_weights, weight, bias, previous_logits):
+    """Unscaled logits of a single classifier, given the pooled outputs of all layers up to it"""
+    # Weighted sum over layers as a single matrix-vector product: (a) x (a, b*c) -> (b, c)
+    weighted_pooled = torch.matmul(sum_weights, pooled.view(sum_weights.size(0), -1)).view(pooled.size(1), pooled.size(2))
+
+    if previous_logits is not None:
+        weighted_pooled = torch.cat([weighted_pooled, previous_logits], dim=1)
+
+    return torch.nn.functional.linear(weighted_pooled, weight, bias)
+
+
 @Model.register("multiloss_bert_for_classification")
 class MultilossBertForClassification(MultilossBert):
     """
@@ -40,6 +52,12 @@ class MultilossBertForClassification(MultilossBert):
         Indices for layers for which linear layers are learned
     multitask: ``bool``, optional (default: false)
         Do multitask learning (rather than summing all losses)
+    half_precision: ``bool``, optional (default: false)
+        Run the BERT encoder under bfloat16 autocast (requires PyTorch >= 1.10)
+    compile_classifiers: ``bool``, optional (default: false)
+        Compile the per-layer classifier computation with ``torch.compile`` (requires PyTorch >= 2.0)
+    share_head: ``bool``, optional (default: false)
+        Use a single classifier for all layers (requires add_previous_layer_logits to be false)
     initializer : ``InitializerApplicator``, optional
         If provided, will be used to initialize the final linear layer *only*.
     """
@@ -59,9 +77,20 @@ class MultilossBertForClassification(MultilossBert):
                  add_previous_layer_logits: bool = True,
                  print_selected_layer: bool = False,
                  ensemble: str = None,
+                 half_precision: bool = False,
+                 compile_classifiers: bool = False,
+                 share_head: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
+        if compile_classifiers and not hasattr(torch, "compile"):
+            raise ConfigurationError("compile_classifiers requires PyTorch >= 2.0 (found {})".format(torch.__version__))
+
+        if share_head and add_previous_layer_logits:
+            raise ConfigurationError("share_head cannot be used with add_previous_layer_logits, "
+                                     "as the classifiers of different layers then have different input sizes")
+
         super().__init__(vocab, bert_model, dropout, num_labels, index, label_namespace, trainable, scaling_temperature, 
-                        temperature_threshold, layer_indices, multitask, debug, add_previous_layer_logits, initializer)
+                        temperature_threshold, layer_indices, multitask, debug, add_previous_layer_logits, half_precision,
+                        initializer)
 
         self._accuracy = CategoricalAccuracy()
 
@@ -81,35 +110,45 @@ class MultilossBertForClassification(MultilossBert):
         else:
             self.ensemble = None
 
+        self._share_head = share_head
+        n_classifiers = 1 if share_head else len(self._layer_indices)
         self._classification_layers = torch.nn.ModuleList([torch.nn.Linear(in_features+(i*out_features*add_previous_layer_logits), out_features)
-                                                            for i in range(len(self._layer_indices))])
+                                                            for i in range(n_classifiers)])
         for l in self._classification_layers:
             initializer(l)
 
+        # Parameters are passed as tensors (rather than modules or indices), so that a single compiled
+        # graph serves all layers
+        if compile_classifiers:
+            self._classifier_logits = torch.compile(_classifier_logits, dynamic=True)
+        else:
+            self._classifier_logits = _classifier_logits
+
 
     def forward(self,  # type: ignore
                 tokens: Dict[str, torch.LongTensor],
                 instance_id: int,
                 label: torch.IntTensor = None,
                 gold_layer: int = None) -> Dict[str, torch.Tensor]:
-        if gold_layer is not None:
-            gold_layer = gold_layer[0]
-
         # pylint: disable=arguments-differ
         """
         Parameters
         ----------
         tokens : Dict[str, torch.LongTensor]
             From a ``TextField`` (that has a bert-pretrained token indexer)
+        instance_id : int
+            From a ``MetadataField``, only used when printing the selected layer
         label : torch.IntTensor, optional (default = None)
             From a ``LabelField``
+        gold_layer : int, optional (default = None)
+            If provided, exit at this classifier rather than based on the temperature threshold
 
         Returns
         -------
         An output dictionary consisting of:
 
-        logits : torch.FloatTensor
-            A tensor of shape ``(batch_size, num_labels)`` representing
+        logits : List[torch.FloatTensor]
+            One tensor of shape ``(batch_size, num_labels)`` per layer that was run, representing
             unnormalized log probabilities of the label.
         probs : torch.FloatTensor
             A tensor of shape ``(batch_size, num_labels)`` representing
@@ -117,58 +156,76 @@ class MultilossBertForClassification(MultilossBert):
         loss : torch.FloatTensor, optional
             A scalar loss to be optimised.
         """
+        if gold_layer is not None:
+            gold_layer = gold_layer[0]
 
         input_ids = tokens[self._index]
-        token_type_ids = tokens[f"{self._index}-type-ids"]
-        input_mask = (input_ids != 0).long()
+        token_type_ids = tokens[self._type_ids_key]
+        input_mask = input_ids.ne(0)
+
+        # Normalizing before the weights are used, as the in-place update would otherwise
+        # invalidate the tensors saved for the backward pass
+        self._normalize_sum_weights()
 
         output_dict = {}
         logit_list = [] 
 
-        encoded_layer, previous_pooled = self._run_layer(input_ids, token_type_ids, input_mask, 0, 0,
-                                                     None, None, logit_list)
-
         n_layers = len(self._layer_indices)
         ensemble = None
 
-        if not self.training:
-            logits = logit_list[0]
-            probs = torch.nn.functional.softmax(logits, dim=-1)
-
-            if self.ensemble is not None:
-                ensemble = self.ensemble[0]*copy.deepcopy(probs)
-            elif (gold_layer is None and torch.max(probs) >= self._temperature_threshold) or \
-                    (gold_layer is not None and gold_layer == 0):
-                n_layers = 1
-#            print("li{}: logits={}, probs={}, thr={}".format(0, logits, probs, self._temperature_threshold))
-        elif self._multitask:
-            n_layers = random.randint(1,n_layers)
-
-        for i in range(1, n_layers):
-            encoded_layer, previous_pooled = self._run_layer(input_ids, token_type_ids, input_mask, i,
-                                                 self._layer_indices[i-1]+1, encoded_layer,
-                                                 previous_pooled, logit_list)
-
-            if not self.training:
-                logits = logit_list[i]
-                probs = torch.nn.functional.softmax(logits, dim=-1)
+        if self.training:
+            if self._multitask:
+                n_layers = random.randint(1,n_layers)
+
+            # No early exit while training: encode all required layers in a single BERT pass,
+            # and feed each classifier the pooled outputs of the layers up to its own
+            _, pooled = super()._run_layer(input_ids, token_type_ids, input_mask, n_layers-1, 0, None, None)
+
+            if self._add_previous_layer_logits:
+                for i in range(n_layers):
+                    self._classify(pooled[:self._layer_indices[i]+1], i, logit_list)
+            else:
+                self._classify_all(pooled, n_layers, logit_list)
+        else:
+            # No gradients are needed at inference time, so skip building the autograd graph
+            with torch.no_grad():
+                encoded_layer, previous_pooled = self._run_layer(input_ids, token_type_ids, input_mask, 0, 0,
+                                                             None, None, logit_list)
+
+                logits = logit_list[0]
+
+                if self.ensemble is not None:
+                    probs = torch.nn.functional.softmax(logits, dim=-1)
+                    ensemble = self.ensemble[0]*copy.deepcopy(probs)
+                elif (gold_layer is None and self._is_confident(logits)) or \
+                        (gold_layer is not None and gold_layer == 0):
+                    n_layers = 1
+#                print("li{}: logits={}, thr={}".format(0, logits, self._temperature_threshold))
+
+                for i, start_index in enumerate(self._start_indices[1:n_layers], 1):
+                    encoded_layer, previous_pooled = self._run_layer(input_ids, token_type_ids, input_mask, i,
+                                                         start_index, encoded_layer,
+                                                         previous_pooled, logit_list)
+
+                    logits = logit_list[i]
 
-#                print("li{}: logits={}, probs={}, thr={}".format(i, logits, probs, self._temperature_threshold))
-                # Ensemble: checking that current prediction equals the previous predictions
-                if ensemble is not None:
-                    ensemble += self.ensemble[i]*probs
-                elif (gold_layer is None and torch.max(probs) >= self._temperature_threshold) or \
-                    (gold_layer is not None and gold_layer == i):
-                    n_layers = i+1
-                    break
+#                    print("li{}: logits={}, thr={}".format(i, logits, self._temperature_threshold))
+                    # Ensemble: checking that current prediction equals the previous predictions
+                    if ensemble is not None:
+                        ensemble += self.ensemble[i]*torch.nn.functional.softmax(logits, dim=-1)
+                    elif (gold_layer is None and self._is_confident(logits)) or \
+                        (gold_layer is not None and gold_layer == i):
+                        n_layers = i+1
+                        break
 
         if not self.training:
             self._count_n_layers(n_layers)
             if self.print_selected_layer:
+                probs = torch.nn.functional.softmax(logits, dim=-1)
                 print("id {} li {} is_correct {} label {} logits {} probs {}".format(instance_id[0], n_layers, (torch.argmax(logits[0]).item() == label.long()).item(), label[0].item(), logits[0], probs[0]))
 
         if label is not None:
-            loss_list = []
+            layer_losses = None
             loss = None
             logits = None
 
@@ -176,13 +233,16 @@ class MultilossBertForClassification(MultilossBert):
                 logits = logit_list[-1] 
                 loss = self._loss(logits, label.long().view(-1))
             else:
-                for i in range(n_layers):
-                    logits = logit_list[i]
-                    loss = self._loss(logits, label.long().view(-1))
-                    loss_list.append(loss)
+                # Computing the losses of all layers with a single cross entropy call
+                stacked_logits = torch.stack(logit_list[:n_layers], dim=0)
+                layer_losses = torch.nn.functional.cross_entropy(stacked_logits.view(-1, stacked_logits.size(-1)),
+                                                                 label.long().view(-1).repeat(n_layers),
+                                                                 reduction='none').view(n_layers, -1).mean(dim=1)
+                loss = torch.sum(layer_losses)
+                logits = logit_list[n_layers-1]
 
             if not self.training and len(self._layer_indices) > 1 and self._debug:
-                print("nl={}, loss_list={}".format(n_layers, loss_list))
+                print("nl={}, layer_losses={}".format(n_layers, layer_losses))
 
             # Ensebmle
             if ensemble is not None:
@@ -193,16 +253,11 @@ class MultilossBertForClassification(MultilossBert):
             output_dict['probs'] = torch.nn.functional.softmax(logits, dim=-1)
             output_dict['logits'] = logit_list
 
-            if self._multitask or n_layers == 1:
-                output_dict['loss'] = loss
-            else:
-                output_dict['loss'] = torch.sum(torch.stack(loss_list, dim=0))
+            output_dict['loss'] = loss
 
             output_dict["correct_label"] = label
             output_dict["n_layers"] = n_layers
 
-        self._normalize_sum_weights()
-
         return output_dict
 
 
@@ -210,20 +265,52 @@ class MultilossBertForClassification(MultilossBert):
         """Run model on a single layer"""
         encoded_layer, pooled = super()._run_layer(input_ids, token_type_ids, input_mask, layer_index, start_index, previous_layer, previous_pooled)
 
-#        print("pooled={}, sw={}".format(pooled.size(), self._sum_weights[layer_index].size()))
+        self._classify(pooled, layer_index, logit_list)
 
-        weighted_pooled = torch.einsum("a,abc->bc", (self._sum_weights[layer_index], pooled))
+        return encoded_layer, pooled
+
+    def _classify(self, pooled, layer_index, logit_list):
+        """Apply the classifier of a single layer to the pooled outputs of all layers up to it"""
+#        print("pooled={}, sw={}".format(pooled.size(), self._sum_weights[layer_index].size()))
 
         # An option to add logits of earlier classifiers as features to the current classifier
-        if self._add_previous_layer_logits:
-            weighted_pooled = torch.cat([weighted_pooled] + logit_list, dim=1)
+        if self._add_previous_layer_logits and logit_list:
+            previous_logits = torch.cat(logit_list, dim=1)
+        else:
+            previous_logits = None
 
         # apply classification layer
-        logits = self._classification_layers[layer_index](weighted_pooled)/self._scaling_temperatures[layer_index]
+        classifier = self._classification_layer(layer_index)
+        logits = self._classifier_logits(pooled, self._sum_weights[layer_index], classifier.weight, classifier.bias,
+                                         previous_logits)
 
-        logit_list.append(logits)
+        logit_list.append(logits/self._scaling_temperatures[layer_index])
 
-        return encoded_layer, pooled
+    def _classify_all(self, pooled, n_layers, logit_list):
+        """Apply the classifiers of the first n_layers layers at once.
+        Only valid when classifiers do not take the logits of earlier layers as features."""
+        n_pooled, batch_size, hidden_size = pooled.size()
+
+        # Sum weights of all classifiers, zero-padded to the number of pooled layers: (n_layers, n_pooled)
+        sum_weights = torch.nn.utils.rnn.pad_sequence([self._sum_weights[i] for i in range(n_layers)], batch_first=True)
+        weighted_pooled = torch.matmul(sum_weights, pooled.view(n_pooled, -1)).view(n_layers, batch_size, hidden_size)
+
+        if self._share_head:
+            logits = self._classification_layers[0](weighted_pooled)
+        else:
+            # Stacked classifier weights, for a single batched matrix product over all layers
+            layers = [self._classification_layers[i] for i in range(n_layers)]
+            weight = torch.stack([l.weight for l in layers], dim=0)
+            bias = torch.stack([l.bias for l in layers], dim=0)
+
+            logits = torch.baddbmm(bias.unsqueeze(1), weighted_pooled, weight.transpose(1, 2))
+
+        logit_list.extend(layer_logits/temperature
+                          for layer_logits, temperature in zip(logits.unbind(0), self._scaling_temperatures))
+
+    def _classification_layer(self, layer_index):
+        """The classifier of a given layer"""
+        return self._classification_layers[0 if self._share_head else layer_index]
 
 
     @overrides
@@ -233,15 +320,11 @@ class MultilossBertForClassification(MultilossBert):
         add ``"label"`` key to the dictionary with the result.
         """
         predictions = output_dict["probs"]
-        if predictions.dim() == 2:
-            predictions_list = [predictions[i] for i in range(predictions.shape[0])]
-        else:
-            predictions_list = [predictions]
-        classes = []
-        for prediction in predictions_list:
-            label_idx = prediction.argmax(dim=-1).item()
-            label_str = self.vocab.get_token_from_index(label_idx, namespace="labels")
-            classes.append(label_str)
+        if predictions.dim() == 1:
+            predictions = predictions.unsqueeze(0)
+        # A single argmax and device transfer for the whole batch
+        label_indices = predictions.argmax(dim=-1).cpu().tolist()
+        classes = [self.vocab.get_token_from_index(label_idx, namespace="labels") for label_idx in label_indices]
         output_dict["label"] = classes
         return output_dict
 
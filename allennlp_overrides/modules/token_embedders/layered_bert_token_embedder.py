@@ -10,13 +10,8 @@ so thanks to them!
 from typing import Dict
 import logging
 
-import torch
-import torch.nn.functional as F
-
 from pytorch_pretrained_bert.modeling import BertModel
 
-from allennlp.modules.scalar_mix import ScalarMix
-from allennlp.nn import util
 from allennlp_overrides.pytorch_pretrained_bert.modeling import LayeredBertModel
 
 logger = logging.getLogger(__name__)
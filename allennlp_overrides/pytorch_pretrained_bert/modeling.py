@@ -18,6 +18,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import copy
+import inspect
 import json
 import logging
 import math
@@ -26,6 +27,7 @@ import shutil
 import tarfile
 import tempfile
 import sys
+import zipfile
 from io import open
 
 import torch
@@ -115,6 +117,16 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
     return model
 
 
+def load_state_dict(weights_path):
+    """ Load a state dict on CPU.
+        The file is memory-mapped rather than read into memory when both the PyTorch version (>= 2.1)
+        and the checkpoint format (zipfile-based serialization) support it.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(weights_path):
+        return torch.load(weights_path, map_location='cpu', mmap=True)
+    return torch.load(weights_path, map_location='cpu')
+
+
 def gelu(x):
     """Implementation of the gelu activation function.
         For information: OpenAI GPT's gelu is slightly different (and gives slightly different results):
@@ -608,7 +620,7 @@ class BertPreTrainedModel(nn.Module):
         model = cls(config, *inputs, **kwargs)
         if state_dict is None and not from_tf:
             weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-            state_dict = torch.load(weights_path, map_location='cpu')
+            state_dict = load_state_dict(weights_path)
         if tempdir:
             # Clean up temp dir
             shutil.rmtree(tempdir)
@@ -676,7 +688,7 @@ class LayeredBertModel(BertPreTrainedModel):
         `token_type_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] with the token
             types indices selected in [0, 1]. Type 0 corresponds to a `sentence A` and type 1 corresponds to
             a `sentence B` token (see BERT paper for more details).
-        `attention_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length] with indices
+        `attention_mask`: an optional torch.LongTensor (or boolean tensor) of shape [batch_size, sequence_length] with indices
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
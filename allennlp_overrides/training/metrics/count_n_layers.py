@@ -1,9 +1,7 @@
 from typing import List
 
 from overrides import overrides
-import torch
 
-from allennlp.common.checks import ConfigurationError
 from allennlp.training.metrics.metric import Metric
 
 